@@ -1,11 +1,135 @@
+import argparse
 import json
 import os
+
+# Use every core for intra-op parallelism; must be set before torch is imported
+os.environ.setdefault("OMP_NUM_THREADS", str(os.cpu_count()))
+
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from sentence_transformers import SentenceTransformer
-import faiss
 import numpy as np
+import orjson
 import re
 
+# torch, sentence_transformers, optimum, transformers and faiss are imported
+# inside the functions that use them. Pool workers that only clean text (and
+# re-import this module under spawn/forkserver) then never load them.
+
+# Product-quantizer layout for the IVF index: 32 sub-quantizers of 8 bits each
+# keeps a 384-dim MiniLM vector in 32 bytes instead of 1536.
+PQ_CODE = "PQ32x8"
+
+# Below this many vectors an exact FP16 flat scan is under 40MB and under 10ms
+# per query on one core, so the recall lost to IVF+PQ buys nothing
+FLAT_INDEX_MAX_VECTORS = 50_000
+
+# Number of inverted lists visited per query on IVF indexes. It is saved with
+# the index, so the app searches with the same setting the recall check used.
+NPROBE = 8
+
+# IVF+PQ indexes whose sampled recall@RECALL_K is below MIN_RECALL are wrapped
+# in IndexRefineFlat, which re-ranks REFINE_K_FACTOR * k PQ candidates exactly
+RECALL_K = 10
+MIN_RECALL = 0.95
+REFINE_K_FACTOR = 16
+
+# Directory holding the ONNX export of the query encoder used by main.py
+ONNX_MODEL_DIR = "onnx_model"
+
+# Patterns used by remove_arabic, compiled once instead of per tafsir entry
+_ARABIC_RE = re.compile(r'[\u0600-\u06FF\u0750-\u077F\u08A0-\u08FF]+')
+_ARABIC_PAREN_RE = re.compile(r'\([^)]*[\u0600-\u06FF\u0750-\u077F\u08A0-\u08FF][^)]*\)')
+_WS_RE = re.compile(r'\s+')
+
+def write_json(path, data, pretty=False):
+    """
+    Serialize data with orjson and write it through a 64KB buffer.
+    Output is compact unless pretty is set, in which case it is indented.
+    """
+    option = orjson.OPT_INDENT_2 if pretty else 0
+    with open(path, 'wb', buffering=1 << 16) as f:
+        f.write(orjson.dumps(data, option=option))
+
+def write_text_store(processed_data, output_dir):
+    """
+    Write the processed data in a form the search app can memory-map:
+    meta.npy holds a structured (surah, verse) array, texts.bin the concatenated
+    UTF-8 explanations, and texts.offsets.npy their N + 1 int64 byte offsets.
+    """
+    meta = np.array([(item['surah'], item['verse_number']) for item in processed_data],
+                    dtype=[('surah', 'i2'), ('verse', 'i2')])
+    encoded = [item['explanation'].encode('utf-8') for item in processed_data]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(text) for text in encoded], out=offsets[1:])
+    
+    np.save(os.path.join(output_dir, "meta.npy"), meta)
+    np.save(os.path.join(output_dir, "texts.offsets.npy"), offsets)
+    with open(os.path.join(output_dir, "texts.bin"), 'wb', buffering=1 << 16) as f:
+        f.writelines(encoded)
+
+def measure_recall(index, embeddings, k=RECALL_K, num_queries=200):
+    """
+    Estimate recall@k of index against an exact IndexFlatIP, using a random
+    sample of the corpus vectors as queries. Each query's own row is left out
+    of both result sets, since finding it is trivial and would inflate recall.
+    """
+    import faiss
+    
+    rng = np.random.default_rng(0)
+    query_ids = rng.choice(len(embeddings), min(num_queries, len(embeddings)), replace=False)
+    queries = embeddings[query_ids]
+    
+    exact = faiss.IndexFlatIP(embeddings.shape[1])
+    exact.add(embeddings)
+    _, expected = exact.search(queries, k + 1)
+    _, found = index.search(queries, k + 1)
+    
+    hits = 0
+    for query_id, e, f in zip(query_ids, expected, found):
+        e = [i for i in e if i != query_id][:k]
+        f = [i for i in f if i != query_id][:k]
+        hits += len(set(e) & set(f))
+    return hits / (len(query_ids) * k)
+
+def build_index(embeddings):
+    """
+    Build an inner-product FAISS index for the given L2-normalized embeddings,
+    so search scores are cosine similarities.
+    
+    Corpora below FLAT_INDEX_MAX_VECTORS get an exact flat scan over FP16
+    scalar-quantized vectors. Larger ones get an IVF+PQ index with roughly
+    sqrt(N) lists, which is wrapped in an exact re-ranking stage if its
+    measured recall falls below MIN_RECALL.
+    """
+    import faiss
+    
+    num_vectors, dimension = embeddings.shape
+    
+    if num_vectors < FLAT_INDEX_MAX_VECTORS:
+        print(f"{num_vectors} vectors, using a flat FP16 index")
+        index = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT)
+        index.train(embeddings)
+        index.add(embeddings)
+    else:
+        nlist = int(np.sqrt(num_vectors))
+        index = faiss.index_factory(dimension, f"IVF{nlist},{PQ_CODE}", faiss.METRIC_INNER_PRODUCT)
+        print(f"Training IVF{nlist},{PQ_CODE} index...")
+        index.train(embeddings)
+        index.add(embeddings)
+        faiss.extract_index_ivf(index).nprobe = NPROBE
+        
+        recall = measure_recall(index, embeddings)
+        if recall < MIN_RECALL:
+            print(f"recall@{RECALL_K} is {recall:.3f}, adding an exact re-ranking stage")
+            index = faiss.IndexRefineFlat(index, faiss.swig_ptr(embeddings))
+            index.k_factor = REFINE_K_FACTOR
+    
+    recall = measure_recall(index, embeddings)
+    print(f"Index recall@{RECALL_K} against exact search: {recall:.3f}")
+    if recall < MIN_RECALL:
+        print(f"Warning: recall is below {MIN_RECALL}; consider raising NPROBE or FLAT_INDEX_MAX_VECTORS")
+    return index
+
 def remove_arabic(text):
     """
     Remove Arabic text and clean the remaining English text.
@@ -14,59 +138,68 @@ def remove_arabic(text):
         return ""
     
     # Remove text between parentheses that contains Arabic
-    text = re.sub(r'\([^)]*[\u0600-\u06FF\u0750-\u077F\u08A0-\u08FF][^)]*\)', '', text)
+    text = _ARABIC_PAREN_RE.sub('', text)
     
     # Remove standalone Arabic text
-    text = re.sub(r'[\u0600-\u06FF\u0750-\u077F\u08A0-\u08FF]+', '', text)
+    text = _ARABIC_RE.sub('', text)
     
     # Clean up extra spaces and punctuation
-    text = re.sub(r'\s+', ' ', text)
+    text = _WS_RE.sub(' ', text)
     text = text.strip()
     
     return text
 
+def _process_one(json_file):
+    """
+    Load and clean a single tafsir file.
+    Returns the processed record, or None if the file has no usable text.
+    """
+    try:
+        print(f"\nProcessing file: {json_file}")
+        
+        with open(json_file, 'rb') as f:
+            data = orjson.loads(f.read())
+            
+            # Check if the file contains the expected structure
+            if isinstance(data, dict) and 'text' in data and 'surah' in data and 'ayah' in data:
+                print(f"Found valid tafsir entry for Surah {data['surah']}, Ayah {data['ayah']}")
+                
+                # Clean the explanation text
+                cleaned_text = remove_arabic(data['text'])
+                
+                if cleaned_text.strip():  # Only add if there's text after cleaning
+                    print(f"Successfully processed Surah {data['surah']}, Verse {data['ayah']}")
+                    print(f"Sample of cleaned text: {cleaned_text[:100]}...")
+                    return {
+                        'surah': data['surah'],
+                        'verse_number': data['ayah'],
+                        'explanation': cleaned_text
+                    }
+                else:
+                    print(f"Warning: No valid text after cleaning for Surah {data['surah']}, Verse {data['ayah']}")
+            else:
+                print(f"Warning: Unexpected JSON structure in {json_file}")
+                print(f"Keys found: {list(data.keys())}")
+    
+    except Exception as e:
+        print(f"Error processing {json_file}: {str(e)}")
+    
+    return None
+
 def process_tafsir_files():
     """
     Process all tafsir files and create a cleaned version with only English text.
+    Files are parsed and cleaned in parallel across all CPU cores.
     """
     tafsir_dir = Path("tafsir/en-tafisr-ibn-kathir")
-    processed_data = []
     
-    # Find all JSON files recursively
-    json_files = list(tafsir_dir.rglob("*.json"))
-    print(f"Found {len(json_files)} JSON files")
+    # Find all JSON files recursively, handing them to the workers as they are found
+    json_files = tafsir_dir.rglob("*.json")
+    print(f"Processing JSON files under {tafsir_dir}")
     
-    for json_file in json_files:
-        try:
-            print(f"\nProcessing file: {json_file}")
-            
-            with open(json_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                
-                # Check if the file contains the expected structure
-                if isinstance(data, dict) and 'text' in data and 'surah' in data and 'ayah' in data:
-                    print(f"Found valid tafsir entry for Surah {data['surah']}, Ayah {data['ayah']}")
-                    
-                    # Clean the explanation text
-                    cleaned_text = remove_arabic(data['text'])
-                    
-                    if cleaned_text.strip():  # Only add if there's text after cleaning
-                        processed_data.append({
-                            'surah': data['surah'],
-                            'verse_number': data['ayah'],
-                            'explanation': cleaned_text
-                        })
-                        print(f"Successfully processed Surah {data['surah']}, Verse {data['ayah']}")
-                        print(f"Sample of cleaned text: {cleaned_text[:100]}...")
-                    else:
-                        print(f"Warning: No valid text after cleaning for Surah {data['surah']}, Verse {data['ayah']}")
-                else:
-                    print(f"Warning: Unexpected JSON structure in {json_file}")
-                    print(f"Keys found: {list(data.keys())}")
-        
-        except Exception as e:
-            print(f"Error processing {json_file}: {str(e)}")
-            continue
+    with ProcessPoolExecutor() as executor:
+        results = executor.map(_process_one, json_files, chunksize=64)
+        processed_data = [record for record in results if record]
     
     # Sort by surah and verse number
     processed_data.sort(key=lambda x: (x['surah'], x['verse_number']))
@@ -74,14 +207,19 @@ def process_tafsir_files():
     
     return processed_data
 
-def create_embeddings(processed_data, output_dir="embeddings"):
+def create_embeddings(processed_data, output_dir="embeddings", pretty=False):
     """
     Create embeddings from the processed data.
+    Set pretty to write the processed data as indented JSON.
     """
     if not processed_data:
         print("No data to process!")
         return
     
+    import faiss
+    import torch
+    from sentence_transformers import SentenceTransformer
+    
     os.makedirs(output_dir, exist_ok=True)
     
     print("Creating embeddings...")
@@ -90,24 +228,16 @@ def create_embeddings(processed_data, output_dir="embeddings"):
     # Get all explanations
     texts = [item['explanation'] for item in processed_data]
     
-    # Process in batches
-    batch_size = 32
-    embeddings_list = []
-    
-    for i in range(0, len(texts), batch_size):
-        batch = texts[i:i + batch_size]
-        print(f"Processing batch {i//batch_size + 1}/{len(texts)//batch_size + 1}")
-        batch_embeddings = model.encode(batch, convert_to_numpy=True)
-        embeddings_list.append(batch_embeddings)
-    
-    # Combine all embeddings
-    embeddings = np.vstack(embeddings_list)
+    # encode batches internally, sorted by length so little compute goes to
+    # padding, and returns rows in the original order of processed_data.
+    # Embeddings are normalized so inner product equals cosine similarity.
+    with torch.inference_mode():
+        embeddings = model.encode(texts, batch_size=64, convert_to_numpy=True,
+                                  show_progress_bar=True, normalize_embeddings=True)
     
     # Create FAISS index
     print("Creating FAISS index...")
-    dimension = embeddings.shape[1]
-    index = faiss.IndexFlatL2(dimension)
-    index.add(embeddings)
+    index = build_index(embeddings)
     
     # Save the results
     index_path = os.path.join(output_dir, "tafsir_semantic_index.index")
@@ -117,12 +247,46 @@ def create_embeddings(processed_data, output_dir="embeddings"):
     faiss.write_index(index, index_path)
     
     print(f"Saving processed data to {data_path}")
-    with open(data_path, 'w', encoding='utf-8') as f:
-        json.dump(processed_data, f, ensure_ascii=False, indent=4)
+    write_json(data_path, processed_data, pretty=pretty)
+    
+    print(f"Saving search metadata and texts to {output_dir}")
+    write_text_store(processed_data, output_dir)
     
     print("Processing completed successfully!")
 
+def export_onnx_model(output_dir=ONNX_MODEL_DIR):
+    """
+    Export all-MiniLM-L6-v2 to ONNX so the app can encode queries with ONNX Runtime.
+    Writes the FP32 model.onnx and a dynamically INT8-quantized model_quantized.onnx.
+    """
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+    
+    print(f"Exporting ONNX query encoder to {output_dir}")
+    model_id = 'sentence-transformers/all-MiniLM-L6-v2'
+    ort_model = ORTModelForFeatureExtraction.from_pretrained(model_id, export=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_id)
+    ort_model.save_pretrained(output_dir)
+    tokenizer.save_pretrained(output_dir)
+    
+    print("Quantizing ONNX query encoder to INT8")
+    quantizer = ORTQuantizer.from_pretrained(ort_model)
+    qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+    quantizer.quantize(save_dir=output_dir, quantization_config=qconfig)
+
 def main():
+    parser = argparse.ArgumentParser(description="Build the tafsir semantic search index.")
+    parser.add_argument('--pretty', action='store_true',
+                        help="write tafsir_verses.json indented for human readability")
+    args = parser.parse_args()
+    
+    import torch
+    
+    # Pin torch threads before any inter-op parallel work has started
+    torch.set_num_threads(os.cpu_count())
+    torch.set_num_interop_threads(1)
+    
     print("Starting tafsir processing...")
     
     # First, process and clean all files
@@ -133,7 +297,10 @@ def main():
         print(json.dumps(processed_data[0], indent=2, ensure_ascii=False))
         
         # Create embeddings from processed data
-        create_embeddings(processed_data)
+        create_embeddings(processed_data, pretty=args.pretty)
+        
+        # Export the query encoder used by the search app
+        export_onnx_model()
     else:
         print("No data was processed. Please check the input files.")
 
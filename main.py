@@ -1,6 +1,13 @@
-import json
+import orjson
 import os
-from sentence_transformers import SentenceTransformer
+
+# Use every core for intra-op parallelism; must be set before torch is imported
+os.environ.setdefault("OMP_NUM_THREADS", str(os.cpu_count()))
+
+# torch, sentence_transformers and transformers are imported inside the
+# functions that use them. The ONNX query path does not need torch, so the
+# app starts without loading it.
+import onnxruntime as ort
 import faiss
 import numpy as np
 import streamlit as st
@@ -9,9 +16,72 @@ from io import BytesIO
 import base64
 from pathlib import Path
 
+INDEX_PATH = "embeddings/tafsir_semantic_index.index"
+META_PATH = "embeddings/meta.npy"
+TEXTS_PATH = "embeddings/texts.bin"
+TEXT_OFFSETS_PATH = "embeddings/texts.offsets.npy"
+# Written by generate_embeddings.export_onnx_model
+ONNX_MODEL_DIR = "onnx_model"
+ONNX_MODEL_PATH = os.path.join(ONNX_MODEL_DIR, "model.onnx")
+ONNX_QUANTIZED_MODEL_PATH = os.path.join(ONNX_MODEL_DIR, "model_quantized.onnx")
+
+# Matches the max_seq_length of the all-MiniLM-L6-v2 sentence-transformers model
+MAX_SEQ_LENGTH = 256
+
+@st.cache_resource
+def _configure_torch_threads():
+    """
+    Pin torch thread counts once per process. Streamlit reruns this script on
+    every interaction, and set_num_interop_threads may only be called once.
+    """
+    import torch
+    
+    torch.set_num_threads(os.cpu_count())
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Already set: clearing the Streamlit cache re-runs this helper
+        pass
+
+
+@st.cache_resource
+def _load_all_verses() -> tuple:
+    """
+    Load the Arabic text and English translation of every verse once per process.
+    
+    Returns:
+        tuple: A dict mapping (surah, verse_number) to the verse's arabic_text and
+            translation, and a dict mapping each surah that failed to load to its error
+    """
+    verses = {}
+    surah_errors = {}
+    for surah_num in range(1, 115):  # 114 Surahs
+        try:
+            with open(f'quranjson/source/surah/surah_{surah_num}.json', 'rb') as f:
+                surah_data = orjson.loads(f.read())
+            with open(f'quranjson/source/translation/en/en_translation_{surah_num}.json', 'rb') as f:
+                translation_data = orjson.loads(f.read())
+            
+            translations = translation_data['verse']
+            for verse_key, verse_text in surah_data['verse'].items():
+                if verse_key in translations:
+                    verse_num = int(verse_key.split("_")[1])
+                    verses[(surah_num, verse_num)] = {
+                        'arabic_text': verse_text,
+                        'translation': translations[verse_key]
+                    }
+        except FileNotFoundError:
+            surah_errors[surah_num] = 'Surah file not found'
+        except orjson.JSONDecodeError:
+            surah_errors[surah_num] = 'Invalid JSON file'
+        except KeyError:
+            surah_errors[surah_num] = 'Verse not found'
+    return verses, surah_errors
+
+
 def get_verse(surah_num: int, verse_num: int) -> dict:
     """
-    Retrieve verse data from Quran JSON files.
+    Retrieve verse data from the preloaded Quran JSON files.
     
     Args:
         surah_num (int): The surah number (1-114)
@@ -20,33 +90,22 @@ def get_verse(surah_num: int, verse_num: int) -> dict:
     Returns:
         dict: A dictionary containing the verse text and translation
     """
-    try:
-        # Load the Arabic text
-        with open(f'quranjson/source/surah/surah_{surah_num}.json', 'r', encoding='utf-8') as f:
-            surah_data = json.load(f)
-            
-        # Load the English translation
-        with open(f'quranjson/source/translation/en/en_translation_{surah_num}.json', 'r', encoding='utf-8') as f:
-            translation_data = json.load(f)
-            
-        # Get the specific verse
-        verse_key = f"verse_{verse_num}"
-        verse_text = surah_data['verse'][verse_key]
-        verse_translation = translation_data['verse'][verse_key]
-        
-        return {
-            'surah': surah_num,
-            'verse_number': verse_num,
-            'arabic_text': verse_text,
-            'translation': verse_translation
-        }
-        
-    except FileNotFoundError:
+    verses, surah_errors = _load_all_verses()
+    if not 1 <= surah_num <= 114:
         return {'error': 'Surah file not found'}
-    except KeyError:
+    if surah_num in surah_errors:
+        return {'error': surah_errors[surah_num]}
+    
+    verse = verses.get((surah_num, verse_num))
+    if verse is None:
         return {'error': 'Verse not found'}
-    except json.JSONDecodeError:
-        return {'error': 'Invalid JSON file'}
+    
+    return {
+        'surah': surah_num,
+        'verse_number': verse_num,
+        'arabic_text': verse['arabic_text'],
+        'translation': verse['translation']
+    }
 
 
 def load_verses() -> list:
@@ -60,10 +119,10 @@ def load_verses() -> list:
     for surah_num in range(1, 115):  # 114 Surahs
         try:
             # Load Surah and Translation files
-            with open(f'quranjson/source/surah/surah_{surah_num}.json', 'r', encoding='utf-8') as f:
-                surah_data = json.load(f)
-            with open(f'quranjson/source/translation/en/en_translation_{surah_num}.json', 'r', encoding='utf-8') as f:
-                translation_data = json.load(f)
+            with open(f'quranjson/source/surah/surah_{surah_num}.json', 'rb') as f:
+                surah_data = orjson.loads(f.read())
+            with open(f'quranjson/source/translation/en/en_translation_{surah_num}.json', 'rb') as f:
+                translation_data = orjson.loads(f.read())
 
             # Combine the verses and translations
             for verse_key, translation in translation_data['verse'].items():
@@ -78,56 +137,176 @@ def load_verses() -> list:
     return all_verses
 
 
-def create_index(verses: list):
+def create_index(verses: list, pretty: bool = False):
     """
     Create a FAISS index from the Quranic translations.
     
     Args:
         verses (list): List of verses with translations.
+        pretty (bool): Write quran_verses.json indented instead of compact.
     """
+    import torch
+    from sentence_transformers import SentenceTransformer
+    from generate_embeddings import build_index, write_json
+    
     model = SentenceTransformer('all-MiniLM-L6-v2')
     translations = [verse['translation'] for verse in verses]
-    embeddings = model.encode(translations, convert_to_numpy=True)
+    with torch.inference_mode():
+        embeddings = model.encode(translations, convert_to_numpy=True)
+    faiss.normalize_L2(embeddings)
 
     # Initialize FAISS index
-    dimension = embeddings.shape[1]
-    index = faiss.IndexFlatL2(dimension)
-    index.add(embeddings)
+    index = build_index(embeddings)
 
     # Save the index and verses data
     faiss.write_index(index, "quran_semantic_index.index")
-    with open("quran_verses.json", "w", encoding="utf-8") as f:
-        json.dump(verses, f, ensure_ascii=False, indent=4)
+    write_json("quran_verses.json", verses, pretty=pretty)
+
+
+@st.cache_resource
+def _load_model():
+    """
+    Load the sentence embedding model once per process.
+    """
+    from sentence_transformers import SentenceTransformer
+    
+    # Pin torch threads before the model does any parallel work
+    _configure_torch_threads()
+    
+    model = SentenceTransformer('all-MiniLM-L6-v2')
+    model.eval()
+    return model
+
+
+def _cpu_has_vnni() -> bool:
+    """
+    Check whether the CPU has VNNI int8 dot-product instructions.
+    Only detectable on Linux; other platforms report False.
+    """
+    try:
+        with open('/proc/cpuinfo', 'r') as f:
+            cpuinfo = f.read()
+    except OSError:
+        return False
+    flags = set(cpuinfo.split())
+    return 'avx512_vnni' in flags or 'avx_vnni' in flags
+
+
+@st.cache_resource
+def _load_onnx_encoder():
+    """
+    Load the exported ONNX query encoder and its tokenizer once per process.
+    The INT8 model is preferred on CPUs with VNNI, otherwise the FP32 model is used.
+    """
+    from transformers import AutoTokenizer
+
+    model_path = ONNX_MODEL_PATH
+    if os.path.exists(ONNX_QUANTIZED_MODEL_PATH) and _cpu_has_vnni():
+        model_path = ONNX_QUANTIZED_MODEL_PATH
+    
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+    tokenizer = AutoTokenizer.from_pretrained(ONNX_MODEL_DIR)
+    return tokenizer, session
+
+
+def encode_query(query: str) -> np.ndarray:
+    """
+    Encode a query into a unit-length embedding.
+    
+    Uses ONNX Runtime when the exported model is available (see
+    generate_embeddings.export_onnx_model) and falls back to SentenceTransformer.
+    """
+    if not os.path.exists(ONNX_MODEL_PATH):
+        import torch
+        model = _load_model()
+        with torch.inference_mode():
+            return model.encode([query], convert_to_numpy=True)
+    
+    tokenizer, session = _load_onnx_encoder()
+    inputs = tokenizer([query], truncation=True, max_length=MAX_SEQ_LENGTH, return_tensors="np")
+    feeds = {i.name: inputs[i.name].astype(np.int64) for i in session.get_inputs()}
+    token_embeddings = session.run(["last_hidden_state"], feeds)[0]
+    
+    # Mean-pool over real tokens and L2 normalize, as the sentence-transformers pipeline does
+    mask = inputs['attention_mask'][..., None].astype(np.float32)
+    embedding = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+    embedding /= np.linalg.norm(embedding, axis=1, keepdims=True)
+    return embedding.astype(np.float32)
+
+
+def _index_mmap_flags(path: str) -> int:
+    """
+    Pick the faiss read flags that memory-map the index stored at path.
+    
+    IO_FLAG_MMAP only maps the inverted lists of an IVF index, while
+    IO_FLAG_MMAP_IFC maps the codes of flat/SQ indexes and IndexRefineFlat
+    wrappers. The two flags cannot be combined on IVF indexes.
+    """
+    with open(path, 'rb') as f:
+        fourcc = f.read(4)
+    # Bare IVF indexes are serialized with an "Iw" fourcc (IwPQ, IwSQ, IwFl, ...)
+    flag = faiss.IO_FLAG_MMAP if fourcc.startswith(b'Iw') else faiss.IO_FLAG_MMAP_IFC
+    return flag | faiss.IO_FLAG_READ_ONLY
+
+
+@st.cache_resource
+def _load_index():
+    """
+    Load the precomputed FAISS index once per process.
+    The index is memory-mapped read-only, so the OS pages it in lazily and
+    shares the pages between app processes.
+    """
+    # nprobe for IVF indexes is saved in the index by generate_embeddings.build_index
+    return faiss.read_index(INDEX_PATH, _index_mmap_flags(INDEX_PATH))
+
+
+@st.cache_resource
+def _load_explanations() -> tuple:
+    """
+    Memory-map the tafsir metadata and explanation texts aligned with the FAISS
+    index once per process (see generate_embeddings.write_text_store).
+    
+    Returns:
+        tuple: The (surah, verse) structured array, the text byte offsets and
+            the concatenated UTF-8 texts
+    """
+    meta = np.load(META_PATH, mmap_mode='r')
+    offsets = np.load(TEXT_OFFSETS_PATH, mmap_mode='r')
+    texts = np.memmap(TEXTS_PATH, dtype=np.uint8, mode='r')
+    return meta, offsets, texts
 
 
 def semantic_search(query: str, top_k=3) -> list:
     """
     Perform semantic search on the tafsir explanations.
     """
-    # Load precomputed index and explanations from embeddings directory
-    index_path = "embeddings/tafsir_semantic_index.index"
-    explanations_path = "embeddings/tafsir_verses.json"
-    
-    if not os.path.exists(index_path) or not os.path.exists(explanations_path):
+    if not all(os.path.exists(path) for path in (INDEX_PATH, META_PATH, TEXTS_PATH, TEXT_OFFSETS_PATH)):
         raise FileNotFoundError("Embeddings files not found. Please run generate_embeddings.py first.")
     
-    index = faiss.read_index(index_path)
-    with open(explanations_path, "r", encoding="utf-8") as f:
-        explanations = json.load(f)
+    index = _load_index()
+    meta, offsets, texts = _load_explanations()
 
     # Encode the query
-    model = SentenceTransformer('all-MiniLM-L6-v2')
-    query_embedding = model.encode([query], convert_to_numpy=True)
+    query_embedding = encode_query(query)
+    faiss.normalize_L2(query_embedding)
 
     # Perform search
-    distances, indices = index.search(query_embedding, top_k)
+    scores, indices = index.search(query_embedding, top_k)
 
     # Retrieve results
     results = []
-    for idx, dist in zip(indices[0], distances[0]):
-        verse = explanations[idx]
-        verse['similarity_score'] = 1 - dist
-        results.append(verse)
+    for idx, score in zip(indices[0], scores[0]):
+        if idx < 0:  # IVF search can return fewer than top_k hits
+            continue
+        results.append({
+            'surah': int(meta['surah'][idx]),
+            'verse_number': int(meta['verse'][idx]),
+            'explanation': texts[offsets[idx]:offsets[idx + 1]].tobytes().decode('utf-8'),
+            # Inner product of unit vectors is the cosine similarity
+            'similarity_score': float(score)
+        })
     return results
 
 
@@ -180,7 +359,7 @@ def main():
         st.header("Search in Tafsir Ibn Kathir")
         
         # Check if embeddings exist
-        if not os.path.exists("embeddings/tafsir_semantic_index.index"):
+        if not os.path.exists(INDEX_PATH):
             st.error("""
                 Embeddings not found. Please run generate_embeddings.py first to create the search index.
                 Command: python generate_embeddings.py
@@ -1,8 +1,7 @@
-import json
+import argparse
+import orjson
 import os
 from pathlib import Path
-import pandas as pd
-import matplotlib.pyplot as plt
 
 def analyze_tafsir_lengths():
     """
@@ -26,13 +25,12 @@ def analyze_tafsir_lengths():
         
         for json_file in json_files:
             try:
-                with open(json_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
+                # Measure the file on disk rather than re-serializing the parsed data
+                length = json_file.stat().st_size
+                with open(json_file, 'rb') as f:
+                    data = orjson.loads(f.read())
                     
-                    # Calculate length of text content
                     if isinstance(data, dict):
-                        text_content = json.dumps(data, ensure_ascii=False)
-                        length = len(text_content)
                         surah_num = json_file.stem  # Get surah number from filename
                         surah_lengths[surah_num] = length
                         total_length += length
@@ -55,6 +53,9 @@ def visualize_results(stats):
     """
     Create visualizations for the tafsir analysis results.
     """
+    # Imported here so runs without --plot skip loading matplotlib
+    import matplotlib.pyplot as plt
+    
     # Prepare data for plotting
     tafsirs = list(stats.keys())
     total_lengths = [stats[t]['total_length'] for t in tafsirs]
@@ -67,20 +68,25 @@ def visualize_results(stats):
     bars1 = ax1.bar(tafsirs, total_lengths)
     ax1.set_title('Total Length of Each Tafsir')
     ax1.set_xlabel('Tafsir')
-    ax1.set_ylabel('Total Length (characters)')
+    ax1.set_ylabel('Total Length (bytes)')
     ax1.tick_params(axis='x', rotation=45)
     
     # Plot average lengths
     bars2 = ax2.bar(tafsirs, avg_lengths)
     ax2.set_title('Average Length per Surah')
     ax2.set_xlabel('Tafsir')
-    ax2.set_ylabel('Average Length (characters)')
+    ax2.set_ylabel('Average Length (bytes)')
     ax2.tick_params(axis='x', rotation=45)
     
     plt.tight_layout()
     return fig
 
 def main():
+    parser = argparse.ArgumentParser(description="Compare the lengths of the available tafsirs.")
+    parser.add_argument('--plot', action='store_true',
+                        help="save bar charts of the results to tafsir_analysis.png")
+    args = parser.parse_args()
+    
     # Analyze tafsir lengths
     stats = analyze_tafsir_lengths()
     
@@ -88,36 +94,30 @@ def main():
     print("\nTafsir Analysis Results:")
     print("=" * 50)
     
-    # Convert to pandas DataFrame for better display
-    results_df = pd.DataFrame({
-        'Total Length': [stats[t]['total_length'] for t in stats],
-        'Average Length': [stats[t]['average_length'] for t in stats],
-        'Verse Count': [stats[t]['verse_count'] for t in stats]
-    }, index=stats.keys())
-    
     # Sort by total length
-    results_df = results_df.sort_values('Total Length', ascending=False)
+    sorted_stats = sorted(stats.items(), key=lambda x: x[1]['total_length'], reverse=True)
     
     # Print results
     print("\nOverall Statistics:")
-    print(results_df)
+    print(f"{'Tafsir':<30} {'Total Length':>12} {'Avg Length':>12} {'Verses':>8}")
+    for tafsir_name, data in sorted_stats:
+        print(f"{tafsir_name:<30} {data['total_length']:>12,} {data['average_length']:>12,.0f} {data['verse_count']:>8}")
     
     # Print detailed comparison
     print("\nDetailed Comparison:")
-    for tafsir_name, data in sorted(stats.items(), 
-                                  key=lambda x: x[1]['total_length'], 
-                                  reverse=True):
+    for tafsir_name, data in sorted_stats:
         print(f"\n{tafsir_name}:")
-        print(f"Total Length: {data['total_length']:,} characters")
-        print(f"Average Length per Surah: {data['average_length']:,.2f} characters")
+        print(f"Total Length: {data['total_length']:,} bytes")
+        print(f"Average Length per Surah: {data['average_length']:,.2f} bytes")
         print(f"Number of verses covered: {data['verse_count']}")
     
-    # Create visualizations
-    fig = visualize_results(stats)
-    
-    # Save the plot
-    fig.savefig('tafsir_analysis.png')
-    print("\nVisualization saved as 'tafsir_analysis.png'")
+    if args.plot:
+        # Create visualizations
+        fig = visualize_results(stats)
+        
+        # Save the plot
+        fig.savefig('tafsir_analysis.png')
+        print("\nVisualization saved as 'tafsir_analysis.png'")
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file